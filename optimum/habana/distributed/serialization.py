@@ -16,17 +16,27 @@
 # The original version can be found at https://github.com/foundation-model-stack/foundation-model-stack
 
 import collections
+import functools
+import json
+import mmap
 import os
-from collections import ChainMap
-from collections.abc import Iterable
+import platform
+import re
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Any, Callable, List, Mapping, MutableMapping, Optional, Union
+from typing import Any, Callable, Dict, List, Mapping, MutableMapping, Optional, Tuple, Union
 
 import torch
+from optimum.utils import logging
 
 from .tp import TPModule
 
 
+logger = logging.get_logger(__name__)
+
+
 __adapters: MutableMapping[str, MutableMapping[str, Callable[[Mapping], Mapping]]] = {}
 
 
@@ -70,12 +80,25 @@ def list_sources(architecture: str):
     return list(__adapters[architecture].keys())
 
 
+def _has_adapter(architecture: str, source: Optional[str]) -> bool:
+    return source is not None and architecture in __adapters and source in __adapters[architecture]
+
+
+class _Identity:
+    __call__ = staticmethod(lambda x: x)
+
+
+# Returned by _get_adapter when the weights are already in fms format, so
+# callers can skip adapting altogether
+_IDENTITY_ADAPTER = _Identity()
+
+
 def _get_adapter(architecture: str, source: Optional[str]) -> Callable[[Mapping[str, Any]], Mapping[str, Any]]:
-    if source is None or architecture not in __adapters or source not in __adapters[architecture]:
+    if not _has_adapter(architecture, source):
         # if no adapter is registered, assume the attributes are already in
         # fms format.
         # should we raise an error here instead?
-        return lambda x: x
+        return _IDENTITY_ADAPTER
     else:
         return __adapters[architecture][source]
 
@@ -94,30 +117,111 @@ def get_adapted(architecture: str, source: Optional[str], state_dict: Mapping[st
     if not len(state_dict):
         return state_dict
     adapter = _get_adapter(architecture, source)
+    if adapter is _IDENTITY_ADAPTER:
+        return state_dict
     adapted = adapter(state_dict)
     return adapted
 
 
-def _get_safetensors_item(key, file: Path, device: torch.device) -> torch.Tensor:
-    from safetensors import safe_open  # type: ignore[import-untyped]
+class _SafetensorsFile:
+    """
+    A safetensors file opened on first use. The header is parsed once and the
+    handle is shared by every thread reading tensors from the file, until
+    `close` is called.
+    """
 
-    with torch.no_grad():
-        with safe_open(file, framework="pt", device=str(device)) as model_weights:  # type: ignore[attr-defined]
-            return model_weights.get_tensor(key)
+    def __init__(self, path: Path, device: torch.device):
+        self.path = path
+        self.device = device
+        self._handle = None
+        self._lock = threading.Lock()
+
+    def handle(self):
+        with self._lock:
+            if self._handle is None:
+                from safetensors import safe_open  # type: ignore[import-untyped]
+
+                self._handle = safe_open(self.path, framework="pt", device=str(self.device))  # type: ignore[attr-defined]
+            return self._handle
+
+    def close(self):
+        with self._lock:
+            if self._handle is not None:
+                self._handle.__exit__(None, None, None)
+                self._handle = None
+
+
+class SafetensorsSliceHandle:
+    """
+    Reference to a tensor of a safetensors file that has not been read yet.
+    Indexing its `get_slice()` reads only the selected part from disk.
+    """
+
+    __slots__ = ("key", "file")
+
+    def __init__(self, key: str, file: _SafetensorsFile):
+        self.key = key
+        self.file = file
+
+    def get_slice(self):
+        return self.file.handle().get_slice(self.key)
+
+    def load(self) -> torch.Tensor:
+        with torch.no_grad():
+            return self.file.handle().get_tensor(self.key)
 
 
 class LazySafetensorsDict(collections.UserDict):
+    def __init__(self, *args, **kwargs):
+        # Files of the lazy entries, keyed by (path, device)
+        self.files: Dict[Tuple[str, str], _SafetensorsFile] = {}
+        super().__init__(*args, **kwargs)
+
+    def get_file(self, file: Path, device: torch.device) -> _SafetensorsFile:
+        file_key = (str(file), str(device))
+        if file_key not in self.files:
+            self.files[file_key] = _SafetensorsFile(file, device)
+        return self.files[file_key]
+
     def set_lazy_tensor(self, key, file, device):
-        super().__setitem__(key, lambda: _get_safetensors_item(key, file, device))
+        super().__setitem__(key, SafetensorsSliceHandle(key, self.get_file(file, device)))
+
+    def close(self):
+        """
+        Closes the files opened to read the lazy entries. Entries still unread
+        reopen their file if they are read afterwards.
+        """
+        for file in self.files.values():
+            file.close()
+
+    def get_lazy(self, key):
+        """
+        Returns the value of `key` without reading it from disk: a
+        SafetensorsSliceHandle if it has not been read yet, or the tensor.
+        """
+        return super().__getitem__(key)
+
+    def pop(self, key, *default):
+        # Entries are dropped as stored, so unread ones are never read from
+        # disk just to be discarded
+        return self.data.pop(key, *default)
 
     def __getitem__(self, key):
         lazy_tensor = super().__getitem__(key)
-        if callable(lazy_tensor):
-            lazy_tensor = lazy_tensor()
+        if isinstance(lazy_tensor, SafetensorsSliceHandle):
+            lazy_tensor = lazy_tensor.load()
             super().__setitem__(key, lazy_tensor)
         return lazy_tensor
 
 
+def _natural_sort_key(path: Path):
+    # Numbers in each component of the path are compared by value, so
+    # `model-10.pth` comes after `model-9.pth` and rank i always gets the i-th
+    # shard. Parent directories are part of the key so that files with the
+    # same name in different directories keep a deterministic order
+    return [[int(chunk) if chunk.isdigit() else chunk for chunk in re.split(r"(\d+)", part)] for part in path.parts]
+
+
 def load_state_dict(
     model_path: Union[str, Path],
     *,
@@ -127,6 +231,7 @@ def load_state_dict(
     initial_device: torch.device = torch.device("cpu"),
     rank: int = 0,
     world_size: int = 1,
+    use_io_uring: bool = False,
 ) -> MutableMapping[str, Any]:
     """
     Validates that the file(s) found at a checkpoint path are compatible with
@@ -149,6 +254,12 @@ def load_state_dict(
             E.g. layer, tp, fsdp.
     initial_device: where the state dict will be loaded if not lazy.
             If meta, return empty dict.
+    use_io_uring: read safetensors checkpoints eagerly with batched io_uring
+            requests instead of lazily through `safe_open`. Only available on
+            Linux with the `liburing` package installed, falls back to the
+            lazy loader otherwise. Ignored when the weights get TP-sharded
+            while loading, as every rank would read all of them in full
+            instead of only its shard.
     """
     if model_path is None or initial_device.type == "meta":
         return {}
@@ -181,7 +292,7 @@ def load_state_dict(
         for glob_pattern_possibility in glob_pattern_list:
             file_list = list(model_path.glob(glob_pattern_possibility))
             if len(file_list) > 0:
-                checkpoints = sorted(file_list)
+                checkpoints = sorted(file_list, key=_natural_sort_key)
                 break
 
     if model_path.is_file():
@@ -207,19 +318,41 @@ def load_state_dict(
 
     checkpoint_sds = []
     if checkpoints[0].suffix == ".safetensors":
+        needs_tp_sharding = checkpoint_sharding != "tp" and distributed_strategy == "tp"
         for ckp in checkpoints:
-            checkpoint_sds.append(
-                _load_safetensors_state_dict(
-                    ckp,
-                    initial_device,
+            if use_io_uring and not needs_tp_sharding:
+                checkpoint_sds.append(_load_safetensors_state_dict_uring(ckp, initial_device))
+            else:
+                checkpoint_sds.append(
+                    _load_safetensors_state_dict(
+                        ckp,
+                        initial_device,
+                    )
                 )
+    else:
+        with ThreadPoolExecutor(max_workers=len(checkpoints)) as executor:
+            checkpoint_sds = list(
+                executor.map(functools.partial(_load_torch_state_dict, device=initial_device), checkpoints)
             )
+    # Merge the state dicts of all the files into one, so that every lookup is
+    # a single probe. When files share a key the first one wins, as with a
+    # ChainMap. Lazy entries are moved as they are, without reading them.
+    if isinstance(checkpoint_sds[0], LazySafetensorsDict):
+        merged_sd = LazySafetensorsDict()
+        for sd in reversed(checkpoint_sds):
+            merged_sd.data.update(sd.data)
+            merged_sd.files.update(sd.files)
     else:
-        with torch.no_grad():
-            checkpoint_sds = [
-                torch.load(str(ckpt_path), map_location=initial_device, mmap=True) for ckpt_path in checkpoints
-            ]
-    return ChainMap(*checkpoint_sds)
+        merged_sd = {}
+        for sd in reversed(checkpoint_sds):
+            merged_sd.update(sd)
+    return merged_sd
+
+
+def _load_torch_state_dict(checkpoint: Path, device: torch.device):
+    # no_grad is thread-local, so it has to be set in each worker
+    with torch.no_grad():
+        return torch.load(str(checkpoint), map_location=device, mmap=True, weights_only=True)
 
 
 def _load_safetensors_state_dict(
@@ -228,15 +361,126 @@ def _load_safetensors_state_dict(
 ):
     sd = LazySafetensorsDict()
 
-    from safetensors import safe_open
+    sd_keys = list(sd.get_file(checkpoint, device).handle().keys())
+    for key in sd_keys:
+        sd.set_lazy_tensor(key, checkpoint, device)
+    return sd
+
+
+_SAFETENSORS_DTYPES = {
+    name: getattr(torch, dtype)
+    for name, dtype in [
+        ("F64", "float64"),
+        ("F32", "float32"),
+        ("F16", "float16"),
+        ("BF16", "bfloat16"),
+        ("F8_E4M3", "float8_e4m3fn"),
+        ("F8_E5M2", "float8_e5m2"),
+        ("I64", "int64"),
+        ("I32", "int32"),
+        ("I16", "int16"),
+        ("I8", "int8"),
+        ("U8", "uint8"),
+        ("BOOL", "bool"),
+    ]
+    if hasattr(torch, dtype)
+}
+
+_URING_QUEUE_DEPTH = 64
+# read(2) transfers at most ~2GiB per call, so larger tensors are split
+_URING_MAX_READ_SIZE = 1 << 30
+
+
+def _read_safetensors_header(checkpoint: Path) -> Tuple[int, Dict[str, Any]]:
+    """
+    Parses the header of a safetensors file: an 8-byte little-endian length
+    followed by a JSON mapping of tensor names to dtype, shape and data offsets.
+    Returns the offset where the tensor data starts and the tensor entries.
+    """
+    with open(checkpoint, "rb") as f:
+        (header_size,) = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(header_size))
+    header.pop("__metadata__", None)
+    return 8 + header_size, header
+
+
+def _load_safetensors_state_dict_uring(
+    checkpoint: Path,
+    device: torch.device,
+):
+    if platform.system() != "Linux":
+        return _load_safetensors_state_dict(checkpoint, device)
+    try:
+        import liburing  # type: ignore[import-not-found]
+    except ImportError:
+        logger.warning("liburing is not installed, falling back to the safetensors loader.")
+        return _load_safetensors_state_dict(checkpoint, device)
+
+    try:
+        return _read_safetensors_uring(liburing, checkpoint, device)
+    except Exception as e:
+        logger.warning(f"io_uring read of {checkpoint} failed ({e}), falling back to the safetensors loader.")
+        return _load_safetensors_state_dict(checkpoint, device)
+
+
+def _read_safetensors_uring(liburing, checkpoint: Path, device: torch.device):
+    data_start, header = _read_safetensors_header(checkpoint)
+
+    # One buffer per tensor, so the tensors can wrap them without copying
+    buffers = {key: bytearray(info["data_offsets"][1] - info["data_offsets"][0]) for key, info in header.items()}
+    reads = []
+    for key, info in header.items():
+        file_offset = data_start + info["data_offsets"][0]
+        view = memoryview(buffers[key])
+        for chunk_start in range(0, len(view), _URING_MAX_READ_SIZE):
+            chunk = view[chunk_start : chunk_start + _URING_MAX_READ_SIZE]
+            reads.append((chunk, file_offset + chunk_start))
+
+    ring = liburing.io_uring()
+    cqes = liburing.io_uring_cqes()
+    liburing.io_uring_queue_init(_URING_QUEUE_DEPTH, ring, 0)
+    try:
+        fd = os.open(checkpoint, os.O_RDONLY)
+        try:
+            for batch_start in range(0, len(reads), _URING_QUEUE_DEPTH):
+                batch = reads[batch_start : batch_start + _URING_QUEUE_DEPTH]
+                for index, (chunk, file_offset) in enumerate(batch):
+                    sqe = liburing.io_uring_get_sqe(ring)
+                    liburing.io_uring_prep_read(sqe, fd, liburing.ffi.from_buffer(chunk), len(chunk), file_offset)
+                    sqe.user_data = index
+                liburing.io_uring_submit_and_wait(ring, len(batch))
+                for _ in batch:
+                    liburing.io_uring_wait_cqe(ring, cqes)
+                    cqe = cqes[0]
+                    read_size = liburing.trap_error(cqe.res)
+                    expected_size = len(batch[cqe.user_data][0])
+                    liburing.io_uring_cqe_seen(ring, cqe)
+                    if read_size != expected_size:
+                        raise OSError(f"Short read from {checkpoint}: {read_size} of {expected_size} bytes")
+        finally:
+            os.close(fd)
+    finally:
+        liburing.io_uring_queue_exit(ring)
 
-    with safe_open(checkpoint, framework="pt", device=str(device)) as model_weights:  # type: ignore[attr-defined]
-        sd_keys = list(model_weights.keys())
-        for key in sd_keys:
-            sd.set_lazy_tensor(key, checkpoint, device)
+    sd = LazySafetensorsDict()
+    with torch.no_grad():
+        for key, info in header.items():
+            dtype = _SAFETENSORS_DTYPES[info["dtype"]]
+            if len(buffers[key]) == 0:
+                tensor = torch.empty(info["shape"], dtype=dtype)
+            else:
+                tensor = torch.frombuffer(buffers[key], dtype=dtype).reshape(info["shape"])
+            if tensor.device != device:
+                tensor = tensor.to(device=device)
+            sd[key] = tensor
     return sd
 
 
+# Number of submodule weight groups read from disk ahead of the one being
+# loaded into the model
+_READ_AHEAD_GROUPS = 4
+
+
 class FusableWeightsMissingError(Exception):
     missing_weights: List[str] = []
 
@@ -283,90 +527,343 @@ def load_state_dict_into_model(
 
     # 2. Decide if model needs sharding and how (for now only TP)
     needs_tp_sharding = checkpoint_sharding != "tp" and distributed_strategy == "tp"
-
-    # 3. Iterate over the weights and load them into the model
+    # Without an adapter checkpoint keys are model keys, so only the shard of
+    # this rank is read from disk, ahead of time like the other weights
+    read_tp_shards = needs_tp_sharding and adapter is _IDENTITY_ADAPTER
+
+    # 3. Group the weights by the submodule they belong to, so that the
+    # adapter and _load_partial_state_dict run once per submodule
+    key_groups: Dict[str, List[str]] = {}
+    for key in state_dict.keys():
+        key_groups.setdefault(key.rpartition(".")[0], []).append(key)
+
+    # 4. Iterate over the groups and load them into the model. The weights of
+    # the next _READ_AHEAD_GROUPS groups are read in the background while the
+    # current one is adapted and copied into the model
+    groups = list(key_groups.values())
     used_keys = set()
-    sd_keys = list(state_dict.keys())
+    prefix_cache: Dict[str, Tuple[Optional[torch.nn.Module], Optional[TPModule]]] = {}
+    try:
+        with torch.no_grad(), ThreadPoolExecutor(max_workers=_READ_AHEAD_GROUPS) as executor:
+            # Safetensors weights are read straight onto initial_device, so they
+            # never need to be moved
+            target_device = None if isinstance(state_dict, LazySafetensorsDict) else torch.device(initial_device)
+            tp_args = (model, rank, world_size, prefix_cache) if read_tp_shards else None
+            fetch_args = (state_dict, target_device, tp_args)
+            pending = collections.deque(
+                executor.submit(_fetch_weights, group_keys, *fetch_args) for group_keys in groups[:_READ_AHEAD_GROUPS]
+            )
+            for group_idx in range(len(groups)):
+                partial_sd = pending.popleft().result()
+                if group_idx + _READ_AHEAD_GROUPS < len(groups):
+                    pending.append(
+                        executor.submit(_fetch_weights, groups[group_idx + _READ_AHEAD_GROUPS], *fetch_args)
+                    )
+                # Weights already loaded with a previous group are skipped
+                partial_sd = {key: value for key, value in partial_sd.items() if key not in used_keys}
+                if not partial_sd:
+                    continue
+                used_keys.update(partial_sd)
+                if adapter is _IDENTITY_ADAPTER:
+                    fms_partial_sd = partial_sd
+                else:
+                    try:
+                        fms_partial_sd = adapter(partial_sd)
+                    except FusableWeightsMissingError as e:
+                        for weight in e.missing_weights:
+                            used_keys.add(weight)
+                            partial_sd[weight] = state_dict[weight]
+                            if partial_sd[weight].device != initial_device:
+                                partial_sd[weight] = partial_sd[weight].to(device=initial_device)
+                        fms_partial_sd = adapter(partial_sd)
+                _load_partial_state_dict(model, fms_partial_sd, needs_tp_sharding, rank, world_size, prefix_cache)
+                for p_key in partial_sd.keys():
+                    state_dict.pop(p_key, None)
+                del partial_sd
+                del fms_partial_sd
+    finally:
+        # Release the safetensors files and staging buffers once the weights
+        # are in the model, or loading failed
+        if isinstance(state_dict, LazySafetensorsDict):
+            state_dict.close()
+        _pinned_pool.clear()
+
+
+def _fetch_weights(
+    keys: List[str],
+    state_dict: MutableMapping[str, Any],
+    target_device: Optional[torch.device],
+    tp_args: Optional[Tuple[torch.nn.Module, int, int, Dict]] = None,
+) -> Dict[str, Any]:
+    """
+    Reads the weights of `keys` from disk. If `tp_args` (model, rank,
+    world_size, prefix_cache) is given, the TP-sharded weights are read as
+    the `_TPShard` of `rank` only.
+    """
+    partial_sd = {}
+    # no_grad is thread-local, so it has to be set in the worker
     with torch.no_grad():
-        for key in sd_keys:
-            if key in used_keys:
-                continue
-            used_keys.add(key)
+        for key in keys:
+            # Entries are resolved without writing them back to state_dict,
+            # which the main thread pops from concurrently
             try:
-                partial_sd = {key: state_dict[key]}
-                if partial_sd[key].device != initial_device:
-                    partial_sd[key] = partial_sd[key].to(device=initial_device)
-                fms_partial_sd = adapter(partial_sd)
-            except FusableWeightsMissingError as e:
-                for weight in e.missing_weights:
-                    used_keys.add(weight)
-                    partial_sd[weight] = state_dict[weight]
-                    if partial_sd[weight].device != initial_device:
-                        partial_sd[weight] = partial_sd[weight].to(device=initial_device)
-                fms_partial_sd = adapter(partial_sd)
-            _load_partial_state_dict(model, fms_partial_sd, needs_tp_sharding, rank, world_size)
-            for p_key in partial_sd.keys():
-                if isinstance(state_dict, ChainMap):
-                    for child_sd in state_dict.maps:
-                        child_sd.pop(p_key, None)
-                else:
-                    state_dict.pop(p_key)
-            del partial_sd
-            del fms_partial_sd
+                partial_sd[key] = _get_lazy(state_dict, key)
+            except KeyError:
+                # Already loaded as a missing weight of a previous group
+                continue
+            if tp_args is not None:
+                shard = _read_tp_shard(key, partial_sd[key], *tp_args)
+                if shard is not None:
+                    if shard.tensor is not None:
+                        if target_device is not None and shard.tensor.device != target_device:
+                            shard.tensor = shard.tensor.to(device=target_device)
+                        _fault_in(shard.tensor)
+                    partial_sd[key] = shard
+                    continue
+            if isinstance(partial_sd[key], SafetensorsSliceHandle):
+                partial_sd[key] = partial_sd[key].load()
+            if isinstance(partial_sd[key], torch.Tensor):
+                if target_device is not None and partial_sd[key].device != target_device:
+                    partial_sd[key] = partial_sd[key].to(device=target_device)
+                _fault_in(partial_sd[key])
+    return partial_sd
+
+
+class _TPShard:
+    """
+    Shard of a TP-sharded weight that belongs to the current rank, read ahead
+    by `_fetch_weights`. `tensor` is None for the rowwise biases of ranks
+    other than 0, which are zeroed instead.
+    """
+
+    __slots__ = ("tensor",)
+
+    def __init__(self, tensor: Optional[torch.Tensor]):
+        self.tensor = tensor
+
+
+def _read_tp_shard(key: str, tensor_value, model: torch.nn.Module, rank: int, world_size: int, prefix_cache: Dict):
+    """
+    Returns the `_TPShard` of `tensor_value` for `rank` if `key` is a
+    TP-sharded parameter of `model`, or None if it is copied as it is.
+    Safetensors weights only have the shard read from disk.
+    """
+    module_path, _, param_name = key.rpartition(".")
+    target_module, tp_module = _find_target_module(model, module_path, prefix_cache)
+    if tp_module is None or not hasattr(target_module, param_name):
+        return None
+    kind = _get_tp_kind(tp_module, module_path.rpartition(".")[2])
+    if kind is None:
+        return None
+    if isinstance(tensor_value, SafetensorsSliceHandle):
+        tensor_value = tensor_value.get_slice()
+    shard = _TP_SHARD_FNS[kind](tensor_value, param_name == "bias", rank, world_size)
+    # Shards of in-memory tensors can be strided views, which are copied so
+    # that only their bytes are read
+    return _TPShard(shard.contiguous() if shard is not None else None)
+
+
+def _fault_in(tensor: torch.Tensor) -> None:
+    """
+    Touches one byte of every page of a CPU tensor. Tensors read lazily from
+    disk (`safe_open` and `torch.load(mmap=True)` on CPU) are views of a memory
+    map, so their bytes are only read on first access: doing it here reads
+    them in the worker instead of in the copy into the model.
+    """
+    if tensor.device.type != "cpu" or tensor.numel() == 0 or not tensor.is_contiguous():
+        return
+    data = tensor.reshape(-1).view(torch.uint8)
+    data[:: mmap.PAGESIZE].max()
+    data[-1:].max()
+
+
+def _chunk(tensor_value, world_size, dim, rank):
+    """
+    Equivalent of `torch.chunk(tensor_value, world_size, dim)[rank]` that
+    also works on safetensors slices, which are indexed so that only the
+    chunk is read from disk. Raises a ValueError if `dim` does not split into
+    `world_size` chunks.
+    """
+    shape = tensor_value.shape if isinstance(tensor_value, torch.Tensor) else tensor_value.get_shape()
+    chunk_size = -(-shape[dim] // world_size)
+    if chunk_size == 0 or -(-shape[dim] // chunk_size) != world_size:
+        raise ValueError(f"Can't split dimension {dim} of size {shape[dim]} into {world_size} TP shards")
+    if isinstance(tensor_value, torch.Tensor):
+        return torch.chunk(tensor_value, world_size, dim=dim)[rank]
+    index = [slice(None)] * len(shape)
+    index[dim] = slice(rank * chunk_size, (rank + 1) * chunk_size)
+    return tensor_value[tuple(index)]
+
+
+def _shard_colwise(tensor_value, is_bias, rank, world_size):
+    """
+    Returns the shard of the weights of a colwise-TP'd module that belongs to
+    `rank`. `tensor_value` can be a tensor or a safetensors slice, in which
+    case only the shard is read from disk.
+    """
+    # Divide the weight matrix (or the bias) along the first dimension.
+    return _chunk(tensor_value, world_size, 0, rank)
+
+
+def _shard_rowwise(tensor_value, is_bias, rank, world_size):
+    """
+    Returns the shard of the weights of a rowwise-TP'd module that belongs to
+    `rank`. `tensor_value` can be a tensor or a safetensors slice, in which
+    case only the shard is read from disk.
+    """
+    # Divide the weight matrix along the last dimension.
+    if not is_bias:
+        return _chunk(tensor_value, world_size, 1, rank)
+    else:
+        # The bias is not sharded: rank 0 copies it and the other ranks zero
+        # theirs without reading it, see _copy_rowwise
+        return tensor_value[:] if rank == 0 else None
+
+
+def _shard_embedding(tensor_value, is_bias, rank, world_size):
+    """
+    Returns the shard of the weights of a TP'd embedding module that belongs to
+    `rank`. `tensor_value` can be a tensor or a safetensors slice, in which
+    case only the shard is read from disk.
+    """
+    # Divide the weight matrix along the last dimension.
+    return _chunk(tensor_value, world_size, 1, rank)
+
+
+_TP_SHARD_FNS = {
+    "colwise": _shard_colwise,
+    "rowwise": _shard_rowwise,
+    "embedding": _shard_embedding,
+}
+
+
+def _get_tp_kind(tp_module: TPModule, module_name: str) -> Optional[str]:
+    # The param names can depend on how the module was configured (e.g. the
+    # number of kv heads), so the map is built per instance on first use
+    kind_map = getattr(tp_module, "_tp_kind_map", None)
+    if kind_map is None:
+        kind_map = {}
+        for kind, names in (
+            ("colwise", tp_module.colwise_param_names()),
+            ("rowwise", tp_module.rowwise_param_names()),
+            ("embedding", tp_module.embedding_param_names()),
+        ):
+            for name in names:
+                kind_map.setdefault(name, kind)
+        tp_module._tp_kind_map = kind_map
+    return kind_map.get(module_name)
+
+
+class _PinnedBufferPool:
+    """
+    Pinned host buffers to stage weights copied to HPU/CUDA parameters. Copies
+    from pageable memory are synchronous even with non_blocking=True, staging
+    them in pinned memory lets the copy overlap with preparing the next weight.
+
+    Two buffers are used in turns, each grown to the size of the largest weight
+    staged in it, and a buffer is only reused once the copy out of it has
+    completed. Weights larger than `max_bytes` are not staged, so the pool
+    pins at most 2 * `max_bytes` of host memory. If the runtime can't pin
+    memory or record events on the device, the pool disables itself and
+    weights are copied directly.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.enabled = True
+        self.slots: List[List[Any]] = []
+
+    def get_or_create(self, nbytes: int) -> List[Any]:
+        if len(self.slots) < 2:
+            slot = [None, None]
+        else:
+            slot = self.slots.pop(0)
+            if slot[1] is not None:
+                slot[1].synchronize()
+        if slot[0] is None or slot[0].numel() < nbytes:
+            slot[0] = torch.empty(nbytes, dtype=torch.uint8, pin_memory=True)
+        self.slots.append(slot)
+        return slot
+
+    def copy_(self, param: torch.nn.Parameter, tensor_value: torch.Tensor):
+        nbytes = tensor_value.numel() * tensor_value.element_size()
+        try:
+            event = getattr(torch, param.device.type).Event()
+            slot = self.get_or_create(nbytes)
+        except (AttributeError, RuntimeError) as e:
+            logger.warning(f"Can't stage weight copies in pinned memory ({e}), copying them directly.")
+            self.enabled = False
+            param.copy_(tensor_value, non_blocking=True)
+            return
+        staging = slot[0][:nbytes].view(tensor_value.dtype).view(tensor_value.shape)
+        staging.copy_(tensor_value)
+        param.copy_(staging, non_blocking=True)
+        event.record()
+        slot[1] = event
+
+    def clear(self):
+        for _, event in self.slots:
+            if event is not None:
+                event.synchronize()
+        self.slots.clear()
+
+
+_pinned_pool = _PinnedBufferPool(max_bytes=256 * 1024 * 1024)
+
+
+def _copy_to_param(param: torch.nn.Parameter, tensor_value):
+    if (
+        _pinned_pool.enabled
+        and param.device.type in ("hpu", "cuda")
+        and tensor_value.device.type == "cpu"
+        and tensor_value.numel() * tensor_value.element_size() <= _pinned_pool.max_bytes
+    ):
+        _pinned_pool.copy_(param, tensor_value)
+    else:
+        param.copy_(tensor_value, non_blocking=True)
 
 
 def _copy_colwise(param: torch.nn.Parameter, tensor_value, is_bias, rank, world_size):
     """
-    This function copies the correct shard of the weights for a colwise-TP'd module
-    according to the rank of the process and the world_size.
+    This function copies the shard of the weights for a colwise-TP'd module
+    that belongs to the current process.
 
     Args
     ====
     param: torch.nn.Parameter
         Parameter that has had TP applied
     tensor_value: torch.Tensor
-        tensor that needs sharding
+        tensor already sharded by `_shard_colwise`
     rank: int
         Rank of the current process
     world_size: int
         Total number of TP processes
     """
-    # Divide the weight matrix along the first dimension.
-    output_size_per_partition = param.shape[0]
-    if not is_bias:
-        tensor = tensor_value[
-            (rank * output_size_per_partition) : ((rank + 1) * output_size_per_partition),
-            :,
-        ]
-    else:
-        tensor = tensor_value[(rank * output_size_per_partition) : ((rank + 1) * output_size_per_partition)]
-    param.copy_(tensor, non_blocking=True)
+    assert param.shape == tensor_value.shape, f"Colwise shard of shape {tensor_value.shape} for a {param.shape} param"
+    _copy_to_param(param, tensor_value)
 
 
 def _copy_rowwise(param: torch.nn.Parameter, tensor_value, is_bias, rank, world_size):
     """
-    This function copies the correct shard of the weights for a rowwise-TP'd module
-    according to the rank of the process and the world_size.
+    This function copies the shard of the weights for a rowwise-TP'd module
+    that belongs to the current process.
 
     Args
     ====
     param: torch.nn.Parameter
         Parameter that has had TP applied
     tensor_value: torch.Tensor
-        tensor that needs sharding
+        tensor already sharded by `_shard_rowwise`
     rank: int
         Rank of the current process
     world_size: int
         Total number of TP processes
     """
-    # Divide the weight matrix along the last dimension.
     if not is_bias:
-        output_size_per_partition = param.shape[1]
-        tensor = tensor_value[
-            :,
-            (rank * output_size_per_partition) : ((rank + 1) * output_size_per_partition),
-        ]
-        param.copy_(tensor, non_blocking=True)
+        assert param.shape == tensor_value.shape, (
+            f"Rowwise shard of shape {tensor_value.shape} for a {param.shape} param"
+        )
+        _copy_to_param(param, tensor_value)
     else:
         if rank == 0:
             _copy_if_present(param, tensor_value)
@@ -376,31 +873,68 @@ def _copy_rowwise(param: torch.nn.Parameter, tensor_value, is_bias, rank, world_
 
 def _copy_embedding(param: torch.nn.Parameter, tensor_value, rank, world_size):
     """
-    This function copies the correct shard of the weights for a TP'd embedding module
-    according to the rank of the process and the world_size.
+    This function copies the shard of the weights for a TP'd embedding module
+    that belongs to the current process.
 
     Args
     ====
     param: torch.nn.Parameter
         Parameter that has had TP applied
     tensor_value: torch.Tensor
-        tensor that needs sharding
+        tensor already sharded by `_shard_embedding`
     rank: int
         Rank of the current process
     world_size: int
         Total number of TP processes
     """
-    # Divide the weight matrix along the last dimension.
-    output_size_per_partition = param.shape[1]
-    tensor = tensor_value[
-        :,
-        (rank * output_size_per_partition) : ((rank + 1) * output_size_per_partition),
-    ]
-    param.copy_(tensor, non_blocking=True)
+    assert param.shape == tensor_value.shape, (
+        f"Embedding shard of shape {tensor_value.shape} for a {param.shape} param"
+    )
+    _copy_to_param(param, tensor_value)
 
 
 def _copy_if_present(parameter, tensor_value):
-    parameter.copy_(tensor_value, non_blocking=True)
+    _copy_to_param(parameter, tensor_value)
+
+
+def _find_target_module(
+    model: torch.nn.Module,
+    module_path: str,
+    prefix_cache: Optional[Dict[str, Tuple[Optional[torch.nn.Module], Optional[TPModule]]]] = None,
+):
+    """
+    Navigates the model tree to find the module at `module_path` (the key of a
+    parameter without its last component) and whether there is a TPModule in
+    the way in case the parameter requires sharding. Returns (None, None) if
+    the path does not exist.
+
+    Resolved prefixes are stored in `prefix_cache`, so each module is found
+    with a single getattr on its already-resolved parent. Children of
+    ModuleList, Sequential and ModuleDict are registered under their index or
+    key, so they are reached the same way.
+    """
+    if prefix_cache is None:
+        prefix_cache = {}
+    if module_path in prefix_cache:
+        return prefix_cache[module_path]
+    if not module_path:
+        return model, None
+
+    parent_path, _, name = module_path.rpartition(".")
+    parent_module, tp_module = _find_target_module(model, parent_path, prefix_cache)
+    target_module = getattr(parent_module, name, None) if parent_module is not None else None
+    if target_module is None:
+        tp_module = None
+    elif isinstance(target_module, TPModule):
+        tp_module = target_module
+    prefix_cache[module_path] = (target_module, tp_module)
+    return target_module, tp_module
+
+
+def _get_lazy(state_dict: MutableMapping[str, Any], key: str):
+    if isinstance(state_dict, LazySafetensorsDict):
+        return state_dict.get_lazy(key)
+    return state_dict[key]
 
 
 def _load_partial_state_dict(
@@ -409,62 +943,66 @@ def _load_partial_state_dict(
     needs_tp_sharding: bool,
     rank=0,
     world_size=1,
+    prefix_cache=None,
 ):
+    # The cache only lives as long as one load of a model
+    if prefix_cache is None:
+        prefix_cache = {}
     unused_params = []
     for key, tensor_value in state_dict.items():
-        target_module = model
-        # Find where to put the weight and decide whether it needs TP'ing
-        key_steps = key.split(".")
-        prefix = ""
-        key_step = 0
-        tp_module = None
-        # Navigate the model tree to find the module where the parameter is
-        # located and whether there is a TPModule in the way in case the
-        # parameter requires sharding
-        while key_step < len(key_steps) - 1:
-            try:
-                target_module = getattr(target_module, key_steps[key_step])
-                if key_step > 0:
-                    prefix += "."
-                prefix += key_steps[key_step]
-                key_step += 1
-                if isinstance(target_module, Iterable):
-                    target_module = target_module[int(key_steps[key_step])]  # type: ignore[index]
-                    prefix += "." + key_steps[key_step]
-                    key_step += 1
-                if isinstance(target_module, TPModule):
-                    tp_module = target_module
-            except AttributeError:
-                unused_params.append(key)
-                break
+        # Find where to put the weight and decide whether it needs TP'ing.
+        # Most keys share their module with a previous key, so the cache is
+        # probed inline before falling back to walking the model tree
+        module_path, _, param_name = key.rpartition(".")
+        resolved = prefix_cache.get(module_path)
+        if resolved is None:
+            resolved = _find_target_module(model, module_path, prefix_cache)
+        target_module, tp_module = resolved
+        if target_module is None:
+            unused_params.append(key)
+            continue
 
         # Check if target_module has the Parameter/buffer
         try:
-            param = getattr(target_module, key_steps[-1])
+            param = getattr(target_module, param_name)
 
             # If TP sharding is not needed, copy the parameter
             # into the model
             if not needs_tp_sharding or tp_module is None:
+                if isinstance(tensor_value, SafetensorsSliceHandle):
+                    tensor_value = tensor_value.load()
                 _copy_if_present(param, tensor_value)
             elif tp_module is not None:
                 # Handle TP sharding
-                if key_steps[-2] in tp_module.colwise_param_names():
+                kind = _get_tp_kind(tp_module, module_path.rpartition(".")[2])
+                if kind is None:
+                    continue
+                is_bias = param_name == "bias"
+                if isinstance(tensor_value, _TPShard):
+                    # Already sharded when it was read ahead
+                    tensor_value = tensor_value.tensor
+                else:
+                    # Unread safetensors weights only read the shard from disk
+                    if isinstance(tensor_value, SafetensorsSliceHandle):
+                        tensor_value = tensor_value.get_slice()
+                    tensor_value = _TP_SHARD_FNS[kind](tensor_value, is_bias, rank, world_size)
+                if kind == "colwise":
                     _copy_colwise(
                         param,
                         tensor_value,
-                        key_steps[-1] == "bias",
+                        is_bias,
                         rank,
                         world_size,
                     )
-                if key_steps[-2] in tp_module.rowwise_param_names():
+                elif kind == "rowwise":
                     _copy_rowwise(
                         param,
                         tensor_value,
-                        key_steps[-1] == "bias",
+                        is_bias,
                         rank,
                         world_size,
                     )
-                if key_steps[-2] in tp_module.embedding_param_names():
+                else:
                     _copy_embedding(
                         param,
                         tensor_value,
@@ -0,0 +1,511 @@
+# coding=utf-8
+# Copyright 2024 HuggingFace Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import tempfile
+import unittest
+from pathlib import Path
+from types import SimpleNamespace
+from unittest import mock
+
+import torch
+from safetensors import safe_open
+from safetensors.torch import load_file, save_file
+
+from optimum.habana.distributed.serialization import (
+    FusableWeightsMissingError,
+    LazySafetensorsDict,
+    SafetensorsSliceHandle,
+    _chunk,
+    _copy_to_param,
+    _natural_sort_key,
+    _PinnedBufferPool,
+    _read_safetensors_uring,
+    _shard_colwise,
+    _shard_embedding,
+    _shard_rowwise,
+    load_state_dict,
+    load_state_dict_into_model,
+    register_adapter,
+)
+from optimum.habana.distributed.tp import TPModule
+
+
+class TinyTPAttention(TPModule):
+    def __init__(self, world_size):
+        super().__init__()
+        self.query = torch.nn.Linear(8, 8 // world_size)
+        self.dense = torch.nn.Linear(8 // world_size, 8)
+
+    def colwise_param_names(self):
+        return ["query"]
+
+    def rowwise_param_names(self):
+        return ["dense"]
+
+    @staticmethod
+    def import_module(module, group):
+        pass
+
+
+class TinyTPModel(torch.nn.Module):
+    def __init__(self, world_size=1):
+        super().__init__()
+        self.layers = torch.nn.ModuleList([TinyTPAttention(world_size) for _ in range(4)])
+        self.norm = torch.nn.LayerNorm(8)
+
+
+class TPShardingTester(unittest.TestCase):
+    """
+    Unit tests for the TP sharding of weights done when loading a state dict,
+    on tensors and on safetensors slices.
+    """
+
+    def setUp(self):
+        self.tensors = {
+            "weight": torch.arange(8 * 12, dtype=torch.float32).reshape(8, 12),
+            "bias": torch.arange(8, dtype=torch.float32),
+        }
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.file = Path(self.tmp_dir.name) / "model.safetensors"
+        save_file(self.tensors, str(self.file))
+        self.handle = safe_open(str(self.file), framework="pt", device="cpu")
+
+    def tearDown(self):
+        self.handle.__exit__(None, None, None)
+        self.tmp_dir.cleanup()
+
+    def test_chunk_tensor_matches_torch_chunk(self):
+        for world_size in [1, 2, 4]:
+            for rank in range(world_size):
+                for dim in [0, 1]:
+                    self.assertTrue(
+                        torch.equal(
+                            _chunk(self.tensors["weight"], world_size, dim, rank),
+                            torch.chunk(self.tensors["weight"], world_size, dim=dim)[rank],
+                        )
+                    )
+
+    def test_chunk_slice_matches_tensor(self):
+        for world_size in [1, 2, 4]:
+            for rank in range(world_size):
+                for dim in [0, 1]:
+                    self.assertTrue(
+                        torch.equal(
+                            _chunk(self.handle.get_slice("weight"), world_size, dim, rank),
+                            _chunk(self.tensors["weight"], world_size, dim, rank),
+                        )
+                    )
+                self.assertTrue(
+                    torch.equal(
+                        _chunk(self.handle.get_slice("bias"), world_size, 0, rank),
+                        _chunk(self.tensors["bias"], world_size, 0, rank),
+                    )
+                )
+
+    def test_chunk_rejects_short_split(self):
+        # 5 rows only split into 3 chunks of 2, 2 and 1
+        short_file = Path(self.tmp_dir.name) / "short.safetensors"
+        save_file({"weight": torch.zeros(5, 4)}, str(short_file))
+        with self.assertRaises(ValueError):
+            _chunk(torch.zeros(5, 4), 4, 0, 3)
+        with safe_open(str(short_file), framework="pt", device="cpu") as handle:
+            with self.assertRaises(ValueError):
+                _chunk(handle.get_slice("weight"), 4, 0, 3)
+
+    def test_shard_colwise(self):
+        for value in [self.tensors, {key: self.handle.get_slice(key) for key in self.tensors}]:
+            self.assertTrue(torch.equal(_shard_colwise(value["weight"], False, 1, 2), self.tensors["weight"][4:, :]))
+            self.assertTrue(torch.equal(_shard_colwise(value["bias"], True, 1, 2), self.tensors["bias"][4:]))
+
+    def test_shard_rowwise(self):
+        for value in [self.tensors, {key: self.handle.get_slice(key) for key in self.tensors}]:
+            self.assertTrue(torch.equal(_shard_rowwise(value["weight"], False, 1, 2), self.tensors["weight"][:, 6:]))
+            # Only rank 0 gets the bias, the other ranks zero theirs
+            self.assertTrue(torch.equal(_shard_rowwise(value["bias"], True, 0, 2), self.tensors["bias"]))
+            self.assertIsNone(_shard_rowwise(value["bias"], True, 1, 2))
+
+    def test_shard_embedding(self):
+        for value in [self.tensors["weight"], self.handle.get_slice("weight")]:
+            self.assertTrue(torch.equal(_shard_embedding(value, False, 0, 3), self.tensors["weight"][:, :4]))
+            self.assertTrue(torch.equal(_shard_embedding(value, False, 2, 3), self.tensors["weight"][:, 8:]))
+
+
+class LoadStateDictIntoModelTester(unittest.TestCase):
+    """
+    Unit tests for loading checkpoints into a model with load_state_dict and
+    load_state_dict_into_model, with and without TP sharding.
+    """
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.weights = {key: value.clone() for key, value in TinyTPModel().state_dict().items()}
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmp_dir.name)
+        # Split the weights over two files of each format
+        keys = sorted(self.weights)
+        for index, file_keys in enumerate([keys[: len(keys) // 2], keys[len(keys) // 2 :]]):
+            save_file({key: self.weights[key] for key in file_keys}, str(self.path / f"model-{index}.safetensors"))
+            torch.save({key: self.weights[key] for key in file_keys}, str(self.path / f"model-{index}.pth"))
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def assert_weights_loaded(self, model):
+        for key, value in model.state_dict().items():
+            self.assertTrue(torch.equal(value, self.weights[key]), key)
+
+    def test_load_pops_every_used_key(self):
+        for suffix in ["safetensors", "pth"]:
+            model = TinyTPModel()
+            state_dict = load_state_dict(f"{self.path}/*.{suffix}")
+            self.assertEqual(len(state_dict), len(self.weights))
+            load_state_dict_into_model(model, state_dict, "tiny", None)
+            self.assert_weights_loaded(model)
+            self.assertEqual(len(state_dict), 0)
+
+    def test_adapter_runs_once_per_submodule(self):
+        groups = []
+
+        def adapter(state_dict):
+            groups.append(sorted(state_dict))
+            return state_dict
+
+        register_adapter("tiny", "grouping", adapter)
+        model = TinyTPModel()
+        load_state_dict_into_model(model, load_state_dict(f"{self.path}/*.safetensors"), "tiny", "grouping")
+        self.assert_weights_loaded(model)
+        expected_groups = {}
+        for key in self.weights:
+            expected_groups.setdefault(key.rpartition(".")[0], []).append(key)
+        self.assertCountEqual(groups, [sorted(keys) for keys in expected_groups.values()])
+
+    def test_fusable_weights_missing_retry(self):
+        # The query of layer 0 needs the query weight of layer 1, whose group
+        # has already been read ahead when the first one is adapted
+        fused_key = "layers.1.query.weight"
+        adapted_keys = []
+        retries = []
+
+        def adapter(state_dict):
+            if "layers.0.query.weight" in state_dict and fused_key not in state_dict:
+                retries.append(sorted(state_dict))
+                raise FusableWeightsMissingError([fused_key])
+            adapted_keys.extend(state_dict)
+            return state_dict
+
+        register_adapter("tiny", "fusing", adapter)
+        for suffix in ["safetensors", "pth"]:
+            adapted_keys.clear()
+            retries.clear()
+            model = TinyTPModel()
+            state_dict = load_state_dict(f"{self.path}/*.{suffix}")
+            load_state_dict_into_model(model, state_dict, "tiny", "fusing")
+            self.assert_weights_loaded(model)
+            self.assertEqual(len(state_dict), 0)
+            self.assertEqual(retries, [["layers.0.query.bias", "layers.0.query.weight"]])
+            # The fused weight is not loaded again with its own group
+            self.assertCountEqual(adapted_keys, self.weights)
+
+    def test_tp_sharding(self):
+        world_size = 2
+        for suffix in ["safetensors", "pth"]:
+            for rank in range(world_size):
+                model = TinyTPModel(world_size)
+                state_dict = load_state_dict(
+                    f"{self.path}/*.{suffix}", distributed_strategy="tp", rank=rank, world_size=world_size
+                )
+                if suffix == "safetensors":
+                    self.assertIsInstance(state_dict, LazySafetensorsDict)
+                load_state_dict_into_model(
+                    model, state_dict, "tiny", None, "tp", None, torch.device("cpu"), rank, world_size
+                )
+                self.assertEqual(len(state_dict), 0)
+                for index, layer in enumerate(model.layers):
+                    prefix = f"layers.{index}."
+                    self.assertTrue(
+                        torch.equal(
+                            layer.query.weight, self.weights[prefix + "query.weight"].chunk(world_size, 0)[rank]
+                        )
+                    )
+                    self.assertTrue(
+                        torch.equal(layer.query.bias, self.weights[prefix + "query.bias"].chunk(world_size, 0)[rank])
+                    )
+                    self.assertTrue(
+                        torch.equal(
+                            layer.dense.weight, self.weights[prefix + "dense.weight"].chunk(world_size, 1)[rank]
+                        )
+                    )
+                    # Only rank 0 holds the rowwise bias, the others zero theirs
+                    expected_bias = self.weights[prefix + "dense.bias"] if rank == 0 else torch.zeros(8)
+                    self.assertTrue(torch.equal(layer.dense.bias, expected_bias))
+                self.assertTrue(torch.equal(model.norm.weight, self.weights["norm.weight"]))
+
+    def test_first_file_wins(self):
+        # model-1 is sorted first, so its copy of a key found in both files is
+        # the one kept
+        path = self.path / "duplicates"
+        path.mkdir()
+        save_file({"norm.weight": torch.zeros(8)}, str(path / "model-1.safetensors"))
+        save_file({"norm.weight": torch.ones(8)}, str(path / "model-2.safetensors"))
+        torch.save({"norm.weight": torch.zeros(8)}, str(path / "model-1.pth"))
+        torch.save({"norm.weight": torch.ones(8)}, str(path / "model-2.pth"))
+        for suffix in ["safetensors", "pth"]:
+            state_dict = load_state_dict(f"{path}/*.{suffix}")
+            self.assertTrue(torch.equal(state_dict["norm.weight"], torch.zeros(8)))
+            if isinstance(state_dict, LazySafetensorsDict):
+                state_dict.close()
+
+
+class FakeEvent:
+    def __init__(self):
+        self.recorded = False
+        self.synchronized = False
+
+    def record(self):
+        self.recorded = True
+
+    def synchronize(self):
+        self.synchronized = True
+
+
+class PinnedBufferPoolTester(unittest.TestCase):
+    """
+    Unit tests for the pool of pinned buffers staging the weights copied to
+    HPU parameters, with the HPU device and its events stubbed.
+    """
+
+    def setUp(self):
+        empty = torch.empty
+        # Pinning host memory needs a device runtime, which is not needed to
+        # test the bookkeeping of the pool
+        patchers = [
+            mock.patch("torch.empty", side_effect=lambda *args, pin_memory=False, **kwargs: empty(*args, **kwargs)),
+            mock.patch.object(torch, "hpu", SimpleNamespace(Event=FakeEvent), create=True),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def make_param(self):
+        param = mock.Mock()
+        param.device = torch.device("hpu")
+        param.copied = []
+        param.copy_.side_effect = lambda tensor, non_blocking=False: param.copied.append(tensor.clone())
+        return param
+
+    def test_slots_are_used_in_turns(self):
+        pool = _PinnedBufferPool(max_bytes=1024)
+        params = [self.make_param() for _ in range(4)]
+        values = [torch.arange(numel, dtype=torch.float32) for numel in [16, 32, 8, 64]]
+
+        pool.copy_(params[0], values[0])
+        pool.copy_(params[1], values[1])
+        self.assertEqual(len(pool.slots), 2)
+        first_buffer, first_event = pool.slots[0]
+        self.assertTrue(first_event.recorded)
+
+        # The third weight reuses the first slot, once its copy has completed,
+        # and fits in its buffer
+        pool.copy_(params[2], values[2])
+        self.assertTrue(first_event.synchronized)
+        self.assertIs(pool.slots[1][0], first_buffer)
+
+        # The fourth weight does not fit in the second buffer, which grows
+        pool.copy_(params[3], values[3])
+        self.assertEqual(pool.slots[1][0].numel(), 64 * 4)
+
+        for param, value in zip(params, values):
+            self.assertEqual(len(param.copied), 1)
+            self.assertTrue(torch.equal(param.copied[0], value))
+
+        events = [event for _, event in pool.slots]
+        pool.clear()
+        self.assertEqual(pool.slots, [])
+        self.assertTrue(all(event.synchronized for event in events))
+
+    def test_large_weights_are_not_staged(self):
+        pool = _PinnedBufferPool(max_bytes=256)
+        with mock.patch("optimum.habana.distributed.serialization._pinned_pool", pool):
+            small, large = torch.ones(64), torch.ones(65)
+            small_param, large_param = self.make_param(), self.make_param()
+            _copy_to_param(small_param, small)
+            _copy_to_param(large_param, large)
+        self.assertEqual(len(pool.slots), 1)
+        self.assertIsNot(small_param.copy_.call_args.args[0], small)
+        self.assertIs(large_param.copy_.call_args.args[0], large)
+
+    def test_falls_back_to_direct_copies(self):
+        pool = _PinnedBufferPool(max_bytes=1024)
+        value = torch.ones(8)
+        with mock.patch.object(torch.hpu, "Event", side_effect=RuntimeError("events are not supported")):
+            with mock.patch("optimum.habana.distributed.serialization._pinned_pool", pool):
+                first_param, second_param = self.make_param(), self.make_param()
+                _copy_to_param(first_param, value)
+                self.assertFalse(pool.enabled)
+                _copy_to_param(second_param, value)
+        self.assertEqual(pool.slots, [])
+        self.assertIs(first_param.copy_.call_args.args[0], value)
+        self.assertIs(second_param.copy_.call_args.args[0], value)
+
+
+class FakeLiburing:
+    """
+    Stand-in for the `liburing` module that serves reads with `os.pread` and
+    completes each batch in reverse order of submission.
+    """
+
+    def __init__(self):
+        self.ffi = SimpleNamespace(from_buffer=lambda buffer: buffer)
+        self.rings = []
+        self.batch_sizes = []
+
+    def io_uring(self):
+        return SimpleNamespace(sqes=[], completed=[])
+
+    def io_uring_cqes(self):
+        return [None]
+
+    def io_uring_queue_init(self, depth, ring, flags):
+        ring.depth = depth
+        self.rings.append(ring)
+
+    def io_uring_queue_exit(self, ring):
+        self.rings.remove(ring)
+
+    def io_uring_get_sqe(self, ring):
+        assert len(ring.sqes) < ring.depth
+        ring.sqes.append(SimpleNamespace(user_data=None))
+        return ring.sqes[-1]
+
+    def io_uring_prep_read(self, sqe, fd, buffer, size, offset):
+        sqe.read = (fd, buffer, size, offset)
+
+    def io_uring_submit_and_wait(self, ring, wait_nr):
+        self.batch_sizes.append(len(ring.sqes))
+        for sqe in ring.sqes:
+            fd, buffer, size, offset = sqe.read
+            data = os.pread(fd, size, offset)
+            buffer[: len(data)] = data
+            ring.completed.insert(0, SimpleNamespace(res=len(data), user_data=sqe.user_data))
+        ring.sqes.clear()
+
+    def io_uring_wait_cqe(self, ring, cqes):
+        cqes[0] = ring.completed[0]
+
+    def io_uring_cqe_seen(self, ring, cqe):
+        ring.completed.remove(cqe)
+
+    def trap_error(self, res):
+        return res
+
+
+class IoUringReaderTester(unittest.TestCase):
+    """
+    Unit tests for the io_uring reader of safetensors files, with a stub of
+    `liburing` backed by `os.pread`.
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.file = Path(self.tmp_dir.name) / "model.safetensors"
+        dtypes = [torch.float32, torch.bfloat16, torch.float16, torch.int64, torch.int8, torch.bool]
+        self.tensors = {}
+        for index in range(100):
+            dtype = dtypes[index % len(dtypes)]
+            # Every 7th tensor is empty
+            shape = (index % 5, 3) if index % 7 else (0, 3)
+            self.tensors[f"tensor_{index}"] = torch.randint(0, 2 if dtype == torch.bool else 100, shape).to(dtype)
+        save_file(self.tensors, str(self.file))
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def assert_tensors_read(self, state_dict):
+        expected = load_file(str(self.file))
+        self.assertEqual(set(state_dict.keys()), set(expected))
+        for key, value in expected.items():
+            self.assertEqual(state_dict[key].dtype, value.dtype, key)
+            self.assertTrue(torch.equal(state_dict[key], value), key)
+
+    def test_read_in_batches(self):
+        liburing = FakeLiburing()
+        self.assert_tensors_read(_read_safetensors_uring(liburing, self.file, torch.device("cpu")))
+        # Empty tensors are not read, the others in batches of the queue depth
+        read_count = sum(value.numel() > 0 for value in self.tensors.values())
+        self.assertEqual(liburing.batch_sizes, [64, read_count - 64])
+        self.assertEqual(liburing.rings, [])
+
+    def test_large_tensors_are_read_in_chunks(self):
+        liburing = FakeLiburing()
+        with mock.patch("optimum.habana.distributed.serialization._URING_MAX_READ_SIZE", 7):
+            self.assert_tensors_read(_read_safetensors_uring(liburing, self.file, torch.device("cpu")))
+        self.assertGreater(sum(liburing.batch_sizes), 85)
+
+    def test_ring_is_exited_on_failure(self):
+        liburing = FakeLiburing()
+        with mock.patch("os.open", side_effect=OSError("can't open")):
+            with self.assertRaises(OSError):
+                _read_safetensors_uring(liburing, self.file, torch.device("cpu"))
+        self.assertEqual(liburing.rings, [])
+
+    def test_tp_sharding_reads_lazily(self):
+        with mock.patch.dict("sys.modules", liburing=FakeLiburing()):
+            state_dict = load_state_dict(str(self.file), use_io_uring=True)
+            self.assertIsInstance(state_dict.get_lazy("tensor_1"), torch.Tensor)
+            self.assert_tensors_read(state_dict)
+            # Only the shard of each rank is read later on, so nothing is read
+            # ahead
+            state_dict = load_state_dict(str(self.file), use_io_uring=True, distributed_strategy="tp", world_size=2)
+            self.assertIsInstance(state_dict.get_lazy("tensor_1"), SafetensorsSliceHandle)
+            state_dict.close()
+
+
+class CheckpointOrderTester(unittest.TestCase):
+    """
+    Unit tests for the order of the checkpoint files found by a glob, which
+    decides the file loaded by each rank for sharded checkpoints.
+    """
+
+    def test_numbers_are_compared_by_value(self):
+        paths = [Path(f"/ckpt/model-{index}.pth") for index in [10, 9, 1, 100, 2]]
+        self.assertEqual(
+            sorted(paths, key=_natural_sort_key),
+            [Path(f"/ckpt/model-{index}.pth") for index in [1, 2, 9, 10, 100]],
+        )
+
+    def test_parent_directories_are_compared(self):
+        paths = [Path(f"/ckpt/{directory}/model.pth") for directory in ["rank10", "rank9", "b", "a"]]
+        self.assertEqual(
+            sorted(paths, key=_natural_sort_key),
+            [Path(f"/ckpt/{directory}/model.pth") for directory in ["a", "b", "rank9", "rank10"]],
+        )
+
+    def test_each_rank_loads_its_shard(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for index in [9, 10]:
+                torch.save({"weight": torch.tensor(index)}, f"{tmp_dir}/model-{index}.pth")
+                Path(f"{tmp_dir}/rank{index}").mkdir()
+                torch.save({"weight": torch.tensor(index)}, f"{tmp_dir}/rank{index}/model.pth")
+            for pattern in ["*.pth", "*/model.pth"]:
+                for rank, index in enumerate([9, 10]):
+                    state_dict = load_state_dict(
+                        f"{tmp_dir}/{pattern}",
+                        distributed_strategy="tp",
+                        checkpoint_sharding="tp",
+                        rank=rank,
+                        world_size=2,
+                    )
+                    self.assertEqual(state_dict["weight"].item(), index)